@@ -11,12 +11,16 @@
 # Copyright 1997 - July 2008 CWI.
 
 from argparse import ArgumentParser
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 import hashlib
 import http.server
-import io
 import logging
 import os
+from pathlib import Path
+import pickle
 import socket
 import socketserver
 import ssl
@@ -27,19 +31,30 @@ import tempfile
 from threading import Thread
 import threading
 from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from urllib.parse import urlsplit
 
 import warnings
 with warnings.catch_warnings():
     warnings.filterwarnings('ignore', category=UserWarning)
     from cryptography import x509
     from cryptography.hazmat.primitives import serialization, hashes
-    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
 
 # Our TLS implementation never uses anything less than TLSv1.3.
 assert ssl.HAS_TLSv1_3
 
 VERSION = "0.3.1"
 
+KEY_ALGORITHMS = ["ed25519", "rsa"]
+
+HANDSHAKE_TIMEOUT = 10
+DEFAULT_HANDSHAKE_THREADS = 8
+
+# Header of a MAPI block: length times two, plus one if it is the last block
+_HEAD = struct.Struct("<h")
+
+PrivateKey = Union[ed25519.Ed25519PrivateKey, rsa.RSAPrivateKey]
+
 DESCRIPTION = f"tlstester.py version {VERSION}: a utility to help test TLS MAPI client implementations."
 
 log = logging.getLogger("tlstester")
@@ -93,6 +108,27 @@ argparser.add_argument(
     type=str,
     help="forward decrypted traffic somewhere else",
 )
+argparser.add_argument(
+    "--key-algorithm",
+    choices=KEY_ALGORITHMS,
+    default="ed25519",
+    help="type of keys to generate, default=ed25519",
+)
+argparser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="always generate fresh keys and certs, do not use or update the cache",
+)
+argparser.add_argument(
+    "--handshake-threads",
+    type=int,
+    metavar="N",
+    # argparse also applies type= to string defaults, so a bad value in
+    # the environment is reported like a bad command line argument
+    default=os.environ.get("TLSTESTER_HANDSHAKE_THREADS", str(DEFAULT_HANDSHAKE_THREADS)),
+    help="number of threads performing the TLS handshake computations, 0 means on the event loop, "
+    f"default=$TLSTESTER_HANDSHAKE_THREADS or {DEFAULT_HANDSHAKE_THREADS}",
+)
 argparser.add_argument(
     "-v", "--verbose", action="store_true", help="Log more information"
 )
@@ -100,18 +136,37 @@ argparser.add_argument(
 
 class Certs:
     hostnames: List[str]
+    key_algorithm: str
     _files: Dict[str, bytes]
-    _keys: Dict[x509.Name, rsa.RSAPrivateKey]
+    _keys: Dict[x509.Name, PrivateKey]
     _certs: Dict[x509.Name, x509.Certificate]
     _parents: Dict[x509.Name, x509.Name]
+    _cert_pem: Dict[x509.Name, bytes]
+    _chain: Dict[x509.Name, List[x509.Name]]
+    _now: datetime
 
-    def __init__(self, hostnames: List[str]):
+    def __init__(
+        self,
+        hostnames: List[str],
+        key_algorithm: str = "ed25519",
+        cache_dir: Optional[str] = None,
+    ):
+        assert key_algorithm in KEY_ALGORITHMS
         self.hostnames = hostnames
+        self.key_algorithm = key_algorithm
         self._files = {}
         self._keys = {}
         self._certs = {}
         self._parents = {}
+        self._cert_pem = {}
+        self._chain = {}
+        # All certificates share the same notion of 'now'
+        self._now = datetime.utcnow()
+        if cache_dir and self.load_cache(cache_dir):
+            return
         self.gen_keys()
+        if cache_dir:
+            self.save_cache(cache_dir)
 
     def get_file(self, name):
         return self._files.get(name)
@@ -119,17 +174,98 @@ class Certs:
     def all(self) -> Dict[str, bytes]:
         return self._files.copy()
 
+    def cache_file(self, cache_dir: str) -> str:
+        # Never use the host names in the file name, they could contain '/'
+        # or '..'. They are stored inside the cache and checked on load.
+        key = "\n".join([self.key_algorithm, *self.hostnames])
+        digest = hashlib.sha256(bytes(key, "utf-8")).hexdigest()
+        return os.path.join(cache_dir, f"{digest}.pickle")
+
+    def load_cache(self, cache_dir: str) -> bool:
+        path = self.cache_file(cache_dir)
+        try:
+            with open(path, "rb") as f:
+                cached = pickle.load(f)
+            if not isinstance(cached, dict):
+                raise TypeError(f"expected a dict, not {type(cached).__name__}")
+            if cached["version"] != VERSION:
+                log.debug(f"Cached certs in {path!r} were made by another version")
+                return False
+            if cached["hostnames"] != self.hostnames or cached["key_algorithm"] != self.key_algorithm:
+                return False
+            if cached["valid_until"] <= datetime.utcnow():
+                log.debug(f"Cached certs in {path!r} are about to expire")
+                return False
+            files = cached["files"]
+            if not isinstance(files, dict):
+                raise TypeError(f"expected a dict of files, not {type(files).__name__}")
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            # The cache must never keep us from starting, whatever is in it
+            log.warning(f"Ignoring unreadable cache file {path!r}: {e!r}")
+            return False
+        log.debug(f"Loaded certs from {path!r}")
+        self._files = files
+        return True
+
+    def save_cache(self, cache_dir: str):
+        now = datetime.utcnow()
+        # Some certificates are expired on purpose, only look at the others.
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category=UserWarning)
+            expiries = [c.not_valid_after for c in self._certs.values()]
+        valid_until = min(t for t in expiries if t > now) - timedelta(1)
+        cached = dict(
+            version=VERSION,
+            hostnames=self.hostnames,
+            key_algorithm=self.key_algorithm,
+            valid_until=valid_until,
+            files=self._files,
+        )
+        path = self.cache_file(cache_dir)
+        # Write to a temporary file first so concurrent runs never
+        # see a partially written cache.
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, temp_name = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(cached, f)
+                os.replace(temp_name, path)
+            except BaseException:
+                os.unlink(temp_name)
+                raise
+        except OSError as e:
+            log.warning(f"Could not write cache file {path!r}: {e}")
+            return
+        log.debug(f"Saved certs to {path!r}")
+
     def gen_keys(self):
-        ca1 = self.gen_ca("ca1")
-        self.gen_server("server1", ca1)
-        self.gen_server("server1x", ca1, not_before=-15, not_after=-1)
-        ca2 = self.gen_ca("ca2")
-        self.gen_server("server2", ca2)
-        self.gen_server("client2", ca2, keycrt=True)
-        ca3 = self.gen_ca("ca3")
-        self.gen_server("server3", ca3)
-
-    def gen_ca(self, name: str):
+        names = ["ca1", "server1", "server1x", "ca2", "server2", "client2", "ca3", "server3"]
+        keys: Dict[str, PrivateKey]
+        if self.key_algorithm == "rsa":
+            # Generating the RSA keys dominates the startup time. Only the
+            # signing depends on other certificates, the keys themselves do
+            # not, so generate all of them at once.
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+                ders = pool.map(_make_key, ["rsa"] * len(names))
+                keys = dict(zip(names, map(load_private_key, ders)))
+        else:
+            # Too cheap to be worth starting worker processes for
+            keys = {name: generate_private_key(self.key_algorithm) for name in names}
+
+        # Sign in dependency order, CA's before the certificates they sign
+        ca1 = self.gen_ca("ca1", keys["ca1"])
+        self.gen_server("server1", ca1, keys["server1"])
+        self.gen_server("server1x", ca1, keys["server1x"], not_before=-15, not_after=-1)
+        ca2 = self.gen_ca("ca2", keys["ca2"])
+        self.gen_server("server2", ca2, keys["server2"])
+        self.gen_server("client2", ca2, keys["client2"], keycrt=True)
+        ca3 = self.gen_ca("ca3", keys["ca3"])
+        self.gen_server("server3", ca3, keys["server3"])
+
+    def gen_ca(self, name: str, key: PrivateKey):
         ca_name = x509.Name(
             [
                 x509.NameAttribute(x509.NameOID.ORGANIZATION_NAME, f"Org {name}"),
@@ -139,12 +275,18 @@ class Certs:
             ]
         )
         critical_ca_extensions = [x509.BasicConstraints(ca=True, path_length=1)]
-        self.gen_key(name, ca_name, critical_extensions=critical_ca_extensions)
+        self.gen_key(name, key, ca_name, critical_extensions=critical_ca_extensions)
 
         return ca_name
 
     def gen_server(
-        self, name: str, ca_name: x509.Name, not_before=0, not_after=14, keycrt=False
+        self,
+        name: str,
+        ca_name: x509.Name,
+        key: PrivateKey,
+        not_before=0,
+        not_after=14,
+        keycrt=False,
     ):
         assert self.hostnames
         server_name = x509.Name(
@@ -158,6 +300,7 @@ class Certs:
         ]
         self.gen_key(
             name=name,
+            key=key,
             subject_name=server_name,
             parent_name=ca_name,
             not_before=not_before,
@@ -169,6 +312,7 @@ class Certs:
     def gen_key(
         self,
         name: str,
+        key: PrivateKey,
         subject_name: x509.Name,
         parent_name: Optional[x509.Name] = None,
         not_before=0,
@@ -177,10 +321,6 @@ class Certs:
         noncritical_extensions: Sequence[x509.ExtensionType] = [],
         keycrt=False,
     ):
-        with warnings.catch_warnings():
-            warnings.filterwarnings('ignore', category=UserWarning)
-            key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
-
         if parent_name:
             issuer_name = parent_name
             issuer_key = self._keys[parent_name]
@@ -188,55 +328,117 @@ class Certs:
             issuer_name = subject_name
             issuer_key = key
 
-        now = datetime.utcnow()
-        builder = (
-            x509.CertificateBuilder()
-            .issuer_name(issuer_name)
-            .subject_name(subject_name)
-            .public_key(key.public_key())
-            .serial_number(x509.random_serial_number())
-            .not_valid_before(now + timedelta(not_before))
-            .not_valid_after(now + timedelta(not_after))
+        cert = self._build_and_sign(
+            key,
+            subject_name,
+            issuer_name,
+            issuer_key,
+            not_before,
+            not_after,
+            critical_extensions,
+            noncritical_extensions,
         )
-        for ext in critical_extensions:
-            builder = builder.add_extension(ext, critical=True)
-        for ext in noncritical_extensions:
-            builder = builder.add_extension(ext, critical=False)
-        cert = builder.sign(issuer_key, hashes.SHA256())
 
         self._keys[subject_name] = key
         self._certs[subject_name] = cert
         if parent_name is not None:
             self._parents[subject_name] = parent_name
+        self._chain[subject_name] = [subject_name] + (self._chain[parent_name] if parent_name else [])
 
+        # Ed25519 keys cannot be written in the traditional format
+        if isinstance(key, rsa.RSAPrivateKey):
+            key_format = serialization.PrivateFormat.TraditionalOpenSSL
+        else:
+            key_format = serialization.PrivateFormat.PKCS8
         pem_key = key.private_bytes(
-            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            format=key_format,
             encoding=serialization.Encoding.PEM,
             encryption_algorithm=serialization.NoEncryption(),
         )
         self.insert_file(f"{name}.key", pem_key)
 
-        n: Optional[x509.Name] = subject_name
-        pem_crt = b""
-        while n:
-            c = self._certs[n]
-            pem_crt += c.public_bytes(serialization.Encoding.PEM)
-            n = self._parents.get(n)
+        # The certificates in the chain have already been serialized when
+        # they were created, reuse them.
+        self._cert_pem[subject_name] = cert.public_bytes(serialization.Encoding.PEM)
+        pem_crt = b"".join(self._cert_pem[n] for n in self._chain[subject_name])
         self.insert_file(f"{name}.crt", pem_crt)
 
-        der_crt = self._certs[subject_name].public_bytes(serialization.Encoding.DER)
+        der_crt = cert.public_bytes(serialization.Encoding.DER)
         self.insert_file(f"{name}.der", der_crt)
 
         if keycrt:
             pem_keycrt = pem_key + pem_crt
             self.insert_file(f"{name}.keycrt", pem_keycrt)
 
+    def _build_and_sign(
+        self,
+        key: PrivateKey,
+        subject_name: x509.Name,
+        issuer_name: x509.Name,
+        issuer_key: PrivateKey,
+        not_before: int,
+        not_after: int,
+        critical_extensions: Sequence[x509.ExtensionType],
+        noncritical_extensions: Sequence[x509.ExtensionType],
+    ) -> x509.Certificate:
+        now = self._now
+        builder = (
+            x509.CertificateBuilder()
+            .issuer_name(issuer_name)
+            .subject_name(subject_name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now + timedelta(not_before))
+            .not_valid_after(now + timedelta(not_after))
+        )
+        for ext in critical_extensions:
+            builder = builder.add_extension(ext, critical=True)
+        for ext in noncritical_extensions:
+            builder = builder.add_extension(ext, critical=False)
+        # Ed25519 does not take a separate hash algorithm
+        if isinstance(issuer_key, rsa.RSAPrivateKey):
+            algorithm: Optional[hashes.SHA256] = hashes.SHA256()
+        else:
+            algorithm = None
+        return builder.sign(issuer_key, algorithm)
+
     def insert_file(self, name, content):
         assert isinstance(content, bytes)
         assert name not in self._files
         self._files[name] = content
 
 
+def generate_private_key(algorithm: str) -> PrivateKey:
+    if algorithm == "rsa":
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category=UserWarning)
+            return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    else:
+        return ed25519.Ed25519PrivateKey.generate()
+
+
+def _make_key(algorithm: str) -> bytes:
+    # Runs in a worker process. Key objects cannot be pickled so we
+    # return the key in serialized form.
+    key = generate_private_key(algorithm)
+    return key.private_bytes(
+        format=serialization.PrivateFormat.PKCS8,
+        encoding=serialization.Encoding.DER,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
+def default_cache_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "tlstester")
+
+
+def load_private_key(der: bytes) -> PrivateKey:
+    key = serialization.load_der_private_key(der, password=None)
+    assert isinstance(key, (ed25519.Ed25519PrivateKey, rsa.RSAPrivateKey))
+    return key
+
+
 class TLSTester:
     certs: Certs
     hostnames: List[str]
@@ -244,8 +446,12 @@ class TLSTester:
     forward_to: Optional[Tuple[str, int]] = None
     preassigned: Dict[str, int]
     portmap: Dict[str, int]
+    root_body: bytes
     next_port: int
     workers: List[Callable[[], None]]
+    mapi_servers: List[Tuple[socket.socket, Callable[..., Any]]]
+    handshake_pool: Optional[ThreadPoolExecutor] = None
+    _ssl_ctx_cache: Dict[Tuple[str, bool, Optional[str], Tuple[str, ...]], SSLContext]
 
     def __init__(
         self,
@@ -256,6 +462,7 @@ class TLSTester:
         forward_host=None,
         forward_port=None,
         hostnames=None,
+        handshake_threads=DEFAULT_HANDSHAKE_THREADS,
     ):
         self.certs = certs
         self.hostnames = hostnames or []
@@ -269,9 +476,22 @@ class TLSTester:
         else:
             self.next_port = 0
         self.workers = []
+        self.mapi_servers = []
+        self._ssl_ctx_cache = {}
+        if handshake_threads > 0:
+            self.handshake_pool = ThreadPoolExecutor(
+                max_workers=handshake_threads, thread_name_prefix="handshake"
+            )
 
         self.spawn_listeners(only_preassigned=True)
         self.spawn_listeners(only_preassigned=False)
+        # The portmap does not change anymore, render it once
+        self.root_body = bytes(
+            "".join(f"{name}:{port}\n" for name, port in self.portmap.items()),
+            "ascii",
+        )
+        if self.mapi_servers:
+            self.workers.append(self.serve_mapi_forever)
 
     def base_port(self) -> int:
         return self.get_port("base")
@@ -313,6 +533,12 @@ class TLSTester:
     def ssl_context(
         self, cert_name: str, allow_tlsv12=False, client_cert=None, hostnames=[]
     ):
+        # Many ports use identical settings and nothing modifies a context
+        # once it has been created, so share them.
+        key = (cert_name, allow_tlsv12, client_cert, tuple(hostnames))
+        if key in self._ssl_ctx_cache:
+            return self._ssl_ctx_cache[key]
+
         context = make_context(allow_tlsv12)
         context.set_alpn_protocols(["mapi/9"])
 
@@ -332,26 +558,8 @@ class TLSTester:
         except AttributeError:
             context.set_servername_callback(sni_callback)
 
-        # Turns out the ssl API forces us to write the certs to file. Yuk!
-        # Complicated code because the delete= and delete_on_close= flags
-        # would be useful but are not available on old Pythons, and
-        # Windows does not allow load_cert_chain to open the file while
-        # the NamedTemporaryFile is not closed.
-        to_delete = None
-        try:
-            temp_file = tempfile.NamedTemporaryFile(mode="wb", delete=False)
-            to_delete = temp_file.name
-            temp_file.write(self.certs.get_file(cert_name + ".key"))
-            temp_file.write(self.certs.get_file(cert_name + ".crt"))
-            temp_file.flush()
-            temp_file.close()   # Cannot open twice on Windows
-            context.load_cert_chain(temp_file.name)
-        finally:
-            try:
-                if to_delete:
-                    os.unlink(to_delete)
-            except OSError:
-                pass
+        key_crt = self.certs.get_file(cert_name + ".key") + self.certs.get_file(cert_name + ".crt")
+        load_cert_chain(context, key_crt)
 
         if client_cert:
             context.verify_mode = ssl.CERT_REQUIRED
@@ -359,6 +567,7 @@ class TLSTester:
             cert_str = str(cert_bytes, "utf-8")
             context.load_verify_locations(cadata=cert_str)
 
+        self._ssl_ctx_cache[key] = context
         return context
 
     def serve_forever(self):
@@ -370,6 +579,18 @@ class TLSTester:
         for t in threads:
             t.join()
 
+    def serve_mapi_forever(self):
+        asyncio.run(self.serve_mapi())
+
+    async def serve_mapi(self):
+        # All MAPI ports are served by a single event loop
+        servers = []
+        for sock, handler in self.mapi_servers:
+            # No ssl= here, MapiHandler does its own TLS, see TLSStream
+            server = await asyncio.start_server(handler, sock=sock)
+            servers.append(server)
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
     def spawn_http(self, name: str, only_preassigned: bool):
         if only_preassigned and name not in self.preassigned:
             return
@@ -377,9 +598,7 @@ class TLSTester:
             return
         port = self.preassigned.get(name, 0)
 
-        def handler(req, addr, server):
-            return WebHandler(req, addr, server, self.certs, self.portmap)
-
+        handler = partial(WebHandler, tlstester=self)
         server = http.server.HTTPServer((self.listen_addr, port), handler)
         port = server.server_address[1]
         log.debug(f"Bound port {name} to {port}")
@@ -393,23 +612,20 @@ class TLSTester:
             return
         port = self.allocate_port(name)
 
-        def handler(req, addr, server):
-            return MapiHandler(req, addr, server, self, name, ctx, check_alpn, redirect_to)
-
-        server = MyTCPServer((self.listen_addr, port), handler)
-        port = server.server_address[1]
+        # MapiHandler keeps no per-connection state so one instance serves all connections
+        handler = MapiHandler(self, name, ctx, check_alpn, redirect_to).handle
+        sock = socket.create_server((self.listen_addr, port))
+        port = sock.getsockname()[1]
         log.debug(f"Bound port {name} to {port}")
         self.portmap[name] = port
-        self.workers.append(server.serve_forever)
+        self.mapi_servers.append((sock, handler))
 
     def spawn_forward(self, name, ctx: SSLContext):
         if name in self.portmap:
             return
         local_port = self.preassigned[name]
 
-        def handler(req, addr, server):
-            return ForwardHandler(req, addr, server, name, ctx, self.forward_to)
-
+        handler = partial(ForwardHandler, name=name, context=ctx, forward=self.forward_to)
         server = MyTCPServer((self.listen_addr, local_port), handler)
         port = server.server_address[1]
         log.debug(f"Bound port {name} to {port}")
@@ -428,11 +644,48 @@ class TLSTester:
         return port
 
 
+def load_cert_chain(context: SSLContext, key_crt: bytes):
+    # Turns out the ssl API forces us to load the certs from a file. Yuk!
+    # On Linux we can use an anonymous in-memory file so the private key
+    # never touches the disk.
+    if hasattr(os, "memfd_create") and os.path.isdir("/proc/self/fd"):
+        try:
+            fd = os.memfd_create("cert", os.MFD_CLOEXEC)
+        except OSError as e:
+            # For example ENOSYS or EPERM under a seccomp profile
+            log.debug(f"memfd_create failed, using a temporary file: {e}")
+        else:
+            with os.fdopen(fd, "wb") as f:
+                f.write(key_crt)
+                f.flush()
+                context.load_cert_chain(f"/proc/self/fd/{fd}")
+            return
+
+    # Otherwise, use a temporary file.
+    # Complicated code because the delete= and delete_on_close= flags
+    # would be useful but are not available on old Pythons, and
+    # Windows does not allow load_cert_chain to open the file while
+    # the NamedTemporaryFile is not closed.
+    to_delete = None
+    try:
+        temp_file = tempfile.NamedTemporaryFile(mode="wb", delete=False)
+        to_delete = temp_file.name
+        temp_file.write(key_crt)
+        temp_file.flush()
+        temp_file.close()   # Cannot open twice on Windows
+        context.load_cert_chain(temp_file.name)
+    finally:
+        try:
+            if to_delete:
+                os.unlink(to_delete)
+        except OSError:
+            pass
+
+
 def make_context(allowtlsv12=False):
     # Older versions of the ssl module don't have ssl.TLSVersion, so
     # we have four combinations.
 
-    protocol = ssl.PROTOCOL_TLS_SERVER
     opts = ssl.OP_NO_SSLv2
     opts |= ssl.OP_NO_SSLv3
     opts |= ssl.OP_NO_TLSv1
@@ -441,8 +694,13 @@ def make_context(allowtlsv12=False):
     else:
         opts |= ssl.OP_NO_TLSv1_2
 
-    context = SSLContext(protocol)
-    context.options = opts
+    # Not ssl.create_default_context(): on Python 3.13 and later it sets
+    # VERIFY_X509_STRICT, which rejects our client certificates because
+    # they lack extensions such as the Authority Key Identifier.
+    # Add to the default options rather than replacing them, so we keep
+    # for example OP_NO_COMPRESSION.
+    context = SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.options |= opts
 
     if hasattr(context, 'minimum_version'):
         context.maximum_version = ssl.TLSVersion.TLSv1_3
@@ -464,17 +722,20 @@ def make_context(allowtlsv12=False):
 
 
 class WebHandler(http.server.BaseHTTPRequestHandler):
+    tlstester: TLSTester
     certs: Certs
-    portmap: Dict[str, int]
 
-    def __init__(self, req, addr, server, certs: Certs, portmap: Dict[str, int]):
-        self.certs = certs
-        self.portmap = portmap
+    # Buffer the output so headers and body go out in a single write.
+    # BaseHTTPRequestHandler flushes after each request.
+    wbufsize = -1
+
+    def __init__(self, req, addr, server, tlstester: TLSTester):
+        self.tlstester = tlstester
+        self.certs = tlstester.certs
         super().__init__(req, addr, server)
 
     def do_GET(self):
-        idx = self.path.find("?")
-        path = self.path[:idx] if idx > 0 else self.path
+        path = urlsplit(self.path).path
         if path == "/":
             return self.do_root()
         content = self.certs.get_file(path[1:])
@@ -483,71 +744,78 @@ class WebHandler(http.server.BaseHTTPRequestHandler):
         self.send_error(http.HTTPStatus.NOT_FOUND)
 
     def do_root(self):
+        body = self.tlstester.root_body
         self.send_response(http.HTTPStatus.OK)
         self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        w = io.TextIOWrapper(
-            self.wfile,
-            encoding="ascii",
-        )
-        for name, port in self.portmap.items():
-            print(f"{name}:{port}", file=w)
-        w.flush()
-        w.detach()
+        self.wfile.write(body)
 
     def do_content(self, content: bytes):
-        try:
-            str(content, encoding="ascii")
+        if content.isascii():
             content_type = "text/plain; charset=utf-8"
-        except UnicodeDecodeError:
+        else:
             content_type = "application/binary"
 
         self.send_response(http.HTTPStatus.OK)
         self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
         self.end_headers()
         self.wfile.write(content)
 
 
 class MyTCPServer(socketserver.ThreadingTCPServer):
     allow_reuse_address = True
-    pass
+    # Do not let lingering connections keep the process alive on exit
+    daemon_threads = True
 
 
-class MapiHandler(socketserver.BaseRequestHandler):
+class MapiHandler:
     tlstester: TLSTester
     name: str
-    context: SSLContext
-    conn: ssl.SSLSocket
+    context: Optional[SSLContext]
     check_alpn: Optional[List[str]]
     redirect: Optional[str]
 
     CHALLENGE = b"s7NzFDHo0UdlE:merovingian:9:RIPEMD160,SHA512,SHA384,SHA256,SHA224,SHA1:LIT:SHA512:"
     ERRORMESSAGE = "Sorry, this is not a real MonetDB instance"
+    # The challenge is the same for every connection, frame it only once
+    FRAMED_CHALLENGE = _HEAD.pack(2 * len(CHALLENGE) + 1) + CHALLENGE
 
-    def __init__(self, req, addr, server, tlstester, name, context, check_alpn, redirect_to):
+    def __init__(self, tlstester, name, context, check_alpn, redirect_to):
         self.tlstester = tlstester
         self.name = name
         self.context = context
         self.check_alpn = check_alpn
         self.redirect = redirect_to
-        super().__init__(req, addr, server)
 
-    def handle(self):
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await self.converse(reader, writer)
+        finally:
+            writer.close()
+
+    async def converse(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         log.debug(f"port '{self.name}': new connection")
         message = f"{self.ERRORMESSAGE} ({self.name})"
+        conn: Union[PlainStream, TLSStream]
         if self.context:
             log.debug(f"port '{self.name}': trying to set up TLS")
+            conn = TLSStream(reader, writer, self.context, self.tlstester.handshake_pool)
             try:
-                self.conn = self.context.wrap_socket(self.request, server_side=True)
-                log.info(f"port '{self.name}': TLS handshake succeeded: {self.conn.version()}")
+                await asyncio.wait_for(conn.do_handshake(), HANDSHAKE_TIMEOUT)
+                log.info(f"port '{self.name}': TLS handshake succeeded: {conn.sslobj.version()}")
             except SSLError as e:
                 log.info(f"port '{self.name}': TLS handshake failed: {e}")
                 return
+            except asyncio.TimeoutError:
+                log.info(f"port '{self.name}': TLS handshake timed out")
+                return
             except OSError as e:
                 log.info(f"port '{self.name}': error during TLS handshake: {e}")
                 return
             if self.check_alpn:
-                alpn = self.conn.selected_alpn_protocol()
+                alpn = conn.sslobj.selected_alpn_protocol()
                 if alpn is None:
                     message = f"Rejecting connection because ALPN negotiation failed"
                     log.info(f"port '{self.name}': {message}")
@@ -557,13 +825,13 @@ class MapiHandler(socketserver.BaseRequestHandler):
                 else:
                     log.debug(f"port '{self.name}': selected correct ALPN protocol '{alpn}'")
         else:
-            self.conn = self.request
+            conn = PlainStream(reader, writer)
             log.info(f"port '{self.name}' no TLS handshake necessary")
 
         try:
-            self.send_message(self.CHALLENGE)
+            await conn.sendall(self.FRAMED_CHALLENGE)
             log.debug(f"port '{self.name}': sent challenge, awaiting response")
-            if self.recv_message():
+            if await self.recv_message(conn):
                 if self.redirect:
                     host = self.tlstester.hostnames[0]
                     port = self.tlstester.portmap[self.redirect]
@@ -572,12 +840,12 @@ class MapiHandler(socketserver.BaseRequestHandler):
                     digest = hashlib.new(algo, cert).hexdigest()
                     fingerprint = algo + ":" + digest
                     msg = f"^monetdbs://{host}:{port}?certhash={fingerprint}\n"
-                    self.send_message(bytes(msg, 'ascii'))
+                    await self.send_message(conn, bytes(msg, 'ascii'))
                     log.debug(
                         f"port '{self.name}': sent redirect, sent closing message"
                     )
                 else:
-                    self.send_message(bytes("!" + message, "utf-8"))
+                    await self.send_message(conn, bytes("!" + message, "utf-8"))
                     log.debug(
                         f"port '{self.name}': received response, sent closing message"
                     )
@@ -585,23 +853,23 @@ class MapiHandler(socketserver.BaseRequestHandler):
         except OSError as e:
             log.info(f"port '{self.name}': error {e}")
 
-    def send_message(self, msg: bytes):
+    async def send_message(self, conn, msg: bytes):
         n = len(msg)
-        head = struct.pack("<h", 2 * n + 1)
-        self.conn.sendall(head + msg)
+        head = _HEAD.pack(2 * n + 1)
+        await conn.sendall(head + msg)
 
-    def recv_message(self):
+    async def recv_message(self, conn):
         nread = 0
         while True:
-            head = self.recv_bytes(2)
+            head = await self.recv_bytes(conn, 2)
             nread += len(head)
             if len(head) < 2:
                 break
-            n = struct.unpack("<h", head)[0]
+            n, = _HEAD.unpack_from(head)
             size = n // 2
             last = (n & 1) > 0
             if size > 0:
-                body = self.recv_bytes(size)
+                body = await self.recv_bytes(conn, size)
                 nread += len(body)
                 if len(body) < size:
                     break
@@ -611,17 +879,98 @@ class MapiHandler(socketserver.BaseRequestHandler):
         log.info(f"port '{self.name}': incomplete message, EOF after {nread} bytes")
         return False
 
-    def recv_bytes(self, size):
+    async def recv_bytes(self, conn, size):
         """Read 'size' bytes. Only return fewer if EOF"""
-        buf = b""
+        buf = bytearray()
         while len(buf) < size:
-            remaining = size - len(buf)
-            more = self.conn.recv(remaining)
-            if more == b"":
-                return buf
-            else:
-                buf += more
-        return buf
+            more = await conn.recv(size - len(buf))
+            if not more:
+                break
+            buf += more
+        return bytes(buf)
+
+
+class PlainStream:
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def recv(self, size: int) -> bytes:
+        return await self.reader.read(size)
+
+    async def sendall(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+
+class TLSStream(PlainStream):
+    """Server side TLS on top of asyncio streams, using memory BIO's.
+
+    We do not use asyncio's own TLS support because it drops the connection
+    without sending the alert when a handshake fails, and sending the
+    right alerts is the whole point of this tool.
+    """
+    incoming: ssl.MemoryBIO
+    outgoing: ssl.MemoryBIO
+    sslobj: ssl.SSLObject
+    pool: Optional[ThreadPoolExecutor]
+
+    def __init__(self, reader, writer, context: SSLContext, pool: Optional[ThreadPoolExecutor] = None):
+        super().__init__(reader, writer)
+        self.pool = pool
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.sslobj = context.wrap_bio(self.incoming, self.outgoing, server_side=True)
+
+    async def do_handshake(self):
+        while True:
+            try:
+                if self.pool:
+                    # The handshake only works on the BIO's so it can run on
+                    # another thread, keeping the crypto off the event loop.
+                    loop = asyncio.get_running_loop()
+                    await loop.run_in_executor(self.pool, self.sslobj.do_handshake)
+                else:
+                    self.sslobj.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                await self.flush()
+                await self.fill()
+            except SSLError:
+                # OpenSSL has queued an alert, make sure the client gets it
+                await self.flush()
+                raise
+        await self.flush()
+
+    async def recv(self, size: int) -> bytes:
+        while True:
+            try:
+                return self.sslobj.read(size)
+            except ssl.SSLWantReadError:
+                await self.flush()
+                await self.fill()
+            except (ssl.SSLZeroReturnError, ssl.SSLEOFError):
+                return b""
+
+    async def sendall(self, data: bytes):
+        self.sslobj.write(data)
+        await self.flush()
+
+    async def flush(self):
+        data = self.outgoing.read()
+        if data:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    async def fill(self):
+        data = await self.reader.read(16384)
+        if data:
+            self.incoming.write(data)
+        else:
+            self.incoming.write_eof()
 
 
 class ForwardHandler(socketserver.BaseRequestHandler):
@@ -691,7 +1040,7 @@ class ForwardHandler(socketserver.BaseRequestHandler):
 
     def send_message(self, msg: bytes):
         n = len(msg)
-        head = struct.pack("<h", 2 * n + 1)
+        head = _HEAD.pack(2 * n + 1)
         self.conn.sendall(head + msg)
 
     def recv_message(self):
@@ -701,7 +1050,7 @@ class ForwardHandler(socketserver.BaseRequestHandler):
             nread += len(head)
             if len(head) < 2:
                 break
-            n = struct.unpack("<h", head)[0]
+            n, = _HEAD.unpack_from(head)
             size = n // 2
             last = (n & 1) > 0
             if size > 0:
@@ -717,15 +1066,15 @@ class ForwardHandler(socketserver.BaseRequestHandler):
 
     def recv_bytes(self, size):
         """Read 'size' bytes. Only return fewer if EOF"""
-        buf = b""
-        while len(buf) < size:
-            remaining = size - len(buf)
-            more = self.conn.recv(remaining)
-            if more == b"":
-                return buf
-            else:
-                buf += more
-        return buf
+        buf = bytearray(size)
+        view = memoryview(buf)
+        pos = 0
+        while pos < size:
+            n = self.conn.recv_into(view[pos:])
+            if n == 0:
+                return bytes(buf[:pos])
+            pos += n
+        return bytes(buf)
 
 
 def main(args):
@@ -738,19 +1087,23 @@ def main(args):
 
     hostnames = args.hostname or ["localhost.localdomain"]
     log.debug(f"Creating certs for {hostnames}")
-    certs = Certs(hostnames)
+    cache_dir = None if args.no_cache else default_cache_dir()
+    certs = Certs(hostnames, key_algorithm=args.key_algorithm, cache_dir=cache_dir)
     if args.write:
         dir = args.write
         try:
             os.mkdir(dir)
         except FileExistsError:
             pass
-        count = 0
-        for name, content in certs.all().items():
-            with open(os.path.join(dir, name), "wb") as a:
-                a.write(content)
-                count += 1
-        log.info(f"Wrote {count} files to {dir!r}")
+        files = certs.all()
+
+        def write_file(item):
+            name, content = item
+            Path(dir, name).write_bytes(content)
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(write_file, files.items()))
+        log.info(f"Wrote {len(files)} files to {dir!r}")
 
     preassigned = dict()
 
@@ -787,6 +1140,7 @@ def main(args):
         sequential=args.sequential,
         forward_host=forward_remote_host,
         forward_port=forward_remote_port,
+        handshake_threads=args.handshake_threads,
     )
 
     log.info(f"Serving requests on base port {server.base_port()}")